@@ -1,31 +1,35 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import time
 import requests
-import os
 import math
+import os
+import shutil
+import json
+import numpy as np
+import shelve
+import atexit
+import threading
+import hashlib
+import tempfile
+import importlib.util
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 1. 环境配置 ---
-os.environ["USE_PYGEOS"] = "0" 
-
-try:
-    import pyogrio
-    import geopandas as gpd
-    # 强制使用 Pyogrio
-    gpd.options.io_engine = "pyogrio"
-    
-    from shapely.geometry import box, Point, Polygon
-    from geopy.geocoders import Nominatim
-    from geopy.distance import distance as geodist
-    import folium
-    from streamlit_folium import st_folium
-except ImportError as e:
-    st.error(f"❌ 环境错误: {e}")
+# GIS 库较重，冷启动时只检查是否已安装，真正的 import 推迟到首次使用的函数里
+_missing = [m for m in ("shapely", "pyproj", "geopy", "folium") if importlib.util.find_spec(m) is None]
+if _missing:
+    st.error(f"❌ 环境错误: 缺少 {', '.join(_missing)}")
     st.stop()
 
+# rasterio 会带上整套 GDAL，是可选依赖（requirements-cog.txt）：没装时只停用 COG 来源
+HAS_RASTERIO = importlib.util.find_spec("rasterio") is not None
+
 # --- 2. 页面设置 ---
 st.set_page_config(page_title="Geo Data Master Pro", page_icon="🏔️", layout="wide")
 
-st.markdown("""
+APP_CSS = """
 <style>
     .stApp { background-color: #f5f5f7; }
     div[data-testid="stSidebar"] { background-color: #ffffff; border-right: 1px solid #e0e0e0; }
@@ -34,72 +38,477 @@ st.markdown("""
     /* 样式微调 */
     .metric-box { background: #eee; padding: 10px; border-radius: 5px; margin-bottom: 10px; font-family: monospace; }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # --- 3. 核心算法 ---
 
-def get_location(query):
-    geolocator = Nominatim(user_agent="geo_master_pro_v7")
+# 常用地名直接返回，不走缓存也不发请求：查询词 -> (lat, lon, address)
+GEO_PRESETS = {
+    "华山": (34.4780, 110.0820, "华山, 华阴市, 渭南市, 陕西省, 中国"),
+    "珠穆朗玛峰": (27.9881, 86.9250, "珠穆朗玛峰, 中国-尼泊尔边界"),
+}
+
+# 按顺序尝试的地理编码服务：名称 -> (geopy 类名, 最小请求间隔/秒)
+# Photon 响应更快，先查；查不到再回退到 Nominatim（其使用政策要求每秒不超过 1 次请求）
+GEO_PROVIDERS = {
+    "photon": ("Photon", 0.5),
+    "nominatim": ("Nominatim", 1.1),
+}
+
+@st.cache_resource
+def _geocoder(name):
+    # 每个服务一个进程级单例，复用内部 HTTP 连接池；所有会话和线程共用同一个限速器
+    from geopy import geocoders
+    from geopy.adapters import RequestsAdapter
+    from geopy.extra.rate_limiter import RateLimiter
+    from urllib3.util import Retry
+
+    cls_name, min_delay = GEO_PROVIDERS[name]
+    # 限流时返回 429/503：按 0.5s、1s、2s 指数退避重试，并遵守 Retry-After
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    geocoder = getattr(geocoders, cls_name)(user_agent="geo_master_pro_v7",
+                                            adapter_factory=functools.partial(RequestsAdapter, max_retries=retry))
+    # 重试已交给适配器，这里不吞异常，免得把服务故障当成“未找到”
+    return RateLimiter(geocoder.geocode, min_delay_seconds=min_delay, max_retries=0, swallow_exceptions=False)
+
+GEO_CACHE_PATH = ".geo_cache.db"
+GEO_CACHE_TTL = 60 * 60 * 24 * 30  # 磁盘缓存条目保留 30 天
+
+@st.cache_resource
+def _geo_disk_cache():
+    # 磁盘缓存在应用重启后依然有效；各会话线程共用同一个 shelve，读写需加锁
+    lock = threading.Lock()
     try:
-        location = geolocator.geocode(query, timeout=10)
+        db = shelve.open(GEO_CACHE_PATH, writeback=False)
+    except Exception:
+        return None, lock
+    atexit.register(db.close)
+    return db, lock
+
+@st.cache_data(ttl=60 * 60 * 24, max_entries=512, show_spinner=False)
+def _geocode(key):
+    db, lock = _geo_disk_cache()
+    if db is not None:
+        with lock:
+            hit = db.get(key)
+        # 条目格式: (lat, lon, addr, 写入时间戳)
+        if hit and time.time() - hit[3] < GEO_CACHE_TTL:
+            return hit[:3]
+
+    # 依次尝试各服务，命中即止；只有全部服务都正常回答“查无此地”才返回（并缓存）None。
+    # 任何一个服务出错都可能是它本来能查到，此时抛出异常：st.cache_data 不缓存异常，
+    # 避免把限流、超时当成“未找到”缓存一整天
+    error = None
+    for name in GEO_PROVIDERS:
+        try:
+            location = _geocoder(name)(key, timeout=10)
+        except Exception as e:
+            error = e
+            continue
         if location:
-            return location.latitude, location.longitude, location.address
-    except:
+            break
+    else:
+        if error is not None:
+            raise error
         return None
-    return None
+    result = (location.latitude, location.longitude, location.address)
+    if db is not None:
+        with lock:
+            db[key] = result + (time.time(),)
+            db.sync()
+    return result
 
-def generate_geodesic_circle(lat, lon, radius_km):
+def get_location(query):
+    """
+    返回 (lat, lon, address)，查无此地时返回 None。
+    服务不可用（限流、超时等）时抛出 geopy 的异常，避免和“未找到”混为一谈。
+    同一查询的并发请求由 st.cache_data 的按键计算锁合并为一次上游调用。
+    """
+    # 规范化后作为缓存键，"华山 " 与 "华山" 命中同一条缓存
+    key = query.strip().lower()
+    if not key:
+        return None
+    if key in GEO_PRESETS:
+        return GEO_PRESETS[key]
+    return _geocode(key)
+
+@st.cache_resource
+def _geod():
+    # WGS84 椭球只初始化一次，矩形和圆形共用
+    from pyproj import Geod
+    return Geod(ellps="WGS84")
+
+EARTH_RADIUS_KM = 6371.0
+RECT_BEARINGS = np.array([0.0, 90.0, 180.0, 270.0]) # 北、东、南、西
+CIRCLE_BEARINGS = np.arange(0.0, 361.0, 5.0) # 每 5 度取一个点，共 72 个点，足够圆滑
+
+def _sphere_destinations(lat, lon, dist_km, bearings):
+    """
+    球面正算：从 (lat, lon) 沿各方位角 bearings（度）前进 dist_km，纯 numpy 一次算完。
+    与 WGS84 椭球解的距离误差约 0.6% 以内（赤道附近南北方向最大），足够用于裁切范围。
+    """
+    phi1, lam1 = np.radians(lat), np.radians(lon)
+    theta = np.radians(bearings)
+    delta = np.asarray(dist_km, dtype=float) / EARTH_RADIUS_KM
+    phi2 = np.arcsin(np.sin(phi1) * np.cos(delta) + np.cos(phi1) * np.sin(delta) * np.cos(theta))
+    lam2 = lam1 + np.arctan2(np.sin(theta) * np.sin(delta) * np.cos(phi1),
+                             np.cos(delta) - np.sin(phi1) * np.sin(phi2))
+    return np.degrees(lam2), np.degrees(phi2)
+
+def _destinations(lat, lon, dist_km, bearings, precise=False):
+    # 默认走球面近似；precise=True 时用 WGS84 椭球正算（距离单位为米）
+    if not precise:
+        return _sphere_destinations(lat, lon, dist_km, bearings)
+    n = len(bearings)
+    lons, lats, _ = _geod().fwd(np.full(n, lon), np.full(n, lat), bearings,
+                                np.broadcast_to(np.asarray(dist_km, dtype=float) * 1000.0, n))
+    return lons, lats
+
+def generate_geodesic_circle(lat, lon, radius_km, precise=False):
     """
     生成真正的测地线圆（解决高纬度椭圆变形问题）。
-    原理：从中心点向 0-360 度方向分别计算 radius_km 处的坐标点，连成多边形。
+    原理：从中心点向 0-360 度方向正算 radius_km 处的坐标点，连成多边形。
     """
-    center_loc = (lat, lon)
-    points = []
-    # 每 5 度取一个点，共 72 个点，足够圆滑
-    for bearing in range(0, 361, 5):
-        dest = geodist(kilometers=radius_km).destination(center_loc, bearing)
-        points.append((dest.longitude, dest.latitude))
-    
-    return Polygon(points)
+    import shapely
+
+    # 坐标数组直接交给 GEOS 建多边形，不经过逐点的 Python 构造
+    lons, lats = _destinations(lat, lon, radius_km, CIRCLE_BEARINGS, precise)
+    return shapely.polygons(np.column_stack([lons, lats]))
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def generate_geometry(lat, lon, shape, width_km, height_km, radius_km, precise=False):
+    # 输入都是可哈希的标量，结果是确定的；返回 WKB 而不是 Shapely 对象，缓存值小且不可变
+    import shapely
 
-def generate_geometry(lat, lon, shape, width_km, height_km, radius_km):
-    center_loc = (lat, lon)
-    
     if shape == "矩形 (Rectangle)":
-        north = geodist(kilometers=height_km/2).destination(center_loc, 0).latitude
-        south = geodist(kilometers=height_km/2).destination(center_loc, 180).latitude
-        east = geodist(kilometers=width_km/2).destination(center_loc, 90).longitude
-        west = geodist(kilometers=width_km/2).destination(center_loc, 270).longitude
-        geom = box(west, south, east, north)
+        # 四个方位角一次向量化算完
+        half_h, half_w = height_km / 2, width_km / 2
+        lons, lats = _destinations(lat, lon, np.array([half_h, half_w, half_h, half_w]), RECT_BEARINGS, precise)
+        north, east, south, west = lats[0], lons[1], lats[2], lons[3]
+        geom = shapely.box(west, south, east, north)
         desc = f"{width_km}x{height_km}km"
     else:
         # 使用新算法生成正圆
-        geom = generate_geodesic_circle(lat, lon, radius_km)
+        geom = generate_geodesic_circle(lat, lon, radius_km, precise)
         desc = f"R{radius_km}km"
         
-    return geom, desc
+    return geom.wkb, geom.bounds, desc
 
-def fetch_opentopo_dem(bounds, api_key):
-    minx, miny, maxx, maxy = [round(x, 5) for x in bounds]
-    
-    # 依然保留 OpenTopo 作为备选，因为它是唯一能自动下载的
-    url = "https://portal.opentopography.org/API/globalDem"
+@st.cache_data(max_entries=64, show_spinner=False)
+def _feature_collection(geom_wkb, name, desc):
+    # WKB 字节是 Shapely 多边形紧凑、可哈希的替身；单个多边形直接拼 GeoJSON，不必经过 GeoDataFrame
+    from shapely import wkb
+    from shapely.geometry import mapping
+
+    return {
+        "type": "FeatureCollection",
+        "features": [{
+            "type": "Feature",
+            "properties": {"name": name, "desc": desc},
+            "geometry": mapping(wkb.loads(geom_wkb)),
+        }],
+    }
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _geojson_for(geom_wkb, name, desc):
+    # 每个 ROI 只序列化一次
+    return json.dumps(_feature_collection(geom_wkb, name, desc), ensure_ascii=False)
+
+@st.cache_resource
+def _http():
+    # 跨重跑、跨会话复用的 HTTP 会话，keep-alive 连接池省去重复的 TCP/TLS 握手
+    from requests.adapters import HTTPAdapter
+    from urllib3.util import Retry
+
+    session = requests.Session()
+    # 只重试幂等的 GET；429 限流时遵守 Retry-After，否则按 1s、2s、4s 退避
+    # raise_on_status=False：重试用完后把最后的响应交给调用方判断状态码，而不是抛出带完整 URL 的 RetryError
+    retry = Retry(total=3, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'],
+                  raise_on_status=False)
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return session
+
+@st.cache_resource
+def _http_probe():
+    # 探测 key 用的轻量会话：不重试，失败就立即返回“暂时无法验证”，不拖慢重跑
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+    return session
+
+# 依然保留 OpenTopo 作为备选，因为它是唯一能自动下载的
+OPENTOPO_URL = "https://portal.opentopography.org/API/globalDem"
+
+# globalDem 接口的数据集代码 (demType) -> 原始格网间距/角秒
+OPENTOPO_DATASETS = {
+    'SRTMGL1': 1,
+    'COP30': 1,
+    'AW3D30': 1,
+    'COP90': 3,
+}
+
+# 原始精度下可选的 30m 数据集：下拉显示名 -> 数据集代码
+DATASET_MAP = {
+    "SRTMGL1 (NASA 30m - 最稳)": 'SRTMGL1',
+    "COP30 (Copernicus 30m)": 'COP30',
+    "AW3D30 (ALOS 30m)": 'AW3D30',
+}
+
+# 下载结果落盘保存；缓存与 session_state 里只放路径。超过两倍缓存 TTL 的文件视为无人引用
+DEM_FILE_TTL = 2 * 3600
+
+@st.cache_resource
+def _dem_dir():
+    # 本进程的 DEM 文件都放在这个临时目录，进程退出时整体删除
+    path = tempfile.mkdtemp(prefix="geo_master_dem_")
+    atexit.register(shutil.rmtree, path, True)
+    return path
+
+def _new_dem_path():
+    # 顺带清理过期文件，长时间运行的进程磁盘占用不会无限增长
+    dem_dir = _dem_dir()
+    now = time.time()
+    for entry in os.scandir(dem_dir):
+        # 其他会话可能同时在清理，文件随时会消失；stat 和 unlink 失败都直接跳过
+        try:
+            if now - entry.stat().st_mtime > DEM_FILE_TTL:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+    fd, path = tempfile.mkstemp(dir=dem_dir, suffix=".tif")
+    os.close(fd)
+    return path
+
+def _file_reader(path):
+    # 交给 st.download_button 的延迟数据：只在用户点击保存时才读盘，平时重跑不把文件读进内存
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+    return read
+
+# 小端 / 大端 TIFF 与 BigTIFF 的文件头
+TIFF_MAGICS = (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _download_opentopo(bounds_key, dem_type, key_digest, _api_key):
+    # 下划线开头的 _api_key 不参与缓存哈希，缓存键里只保留 key 的摘要
+    minx, miny, maxx, maxy = bounds_key
     params = {
-        'demType': 'SRTMGL1', # 回归最稳的 SRTM
-        'south': miny, 'north': maxy, 'west': minx, 'east': maxx,
+        'demType': dem_type,
+        # 直接格式化成字符串，省得 urlencode 再把浮点转一遍
+        'south': f'{miny:.5f}', 'north': f'{maxy:.5f}', 'west': f'{minx:.5f}', 'east': f'{maxx:.5f}',
         'outputFormat': 'GTiff',
-        'API_Key': api_key
+        'API_Key': _api_key
     }
-    
-    try:
-        r = requests.get(url, params=params, stream=True, timeout=60)
+
+    # 失败时抛异常而不是返回错误信息，st.cache_data 不会缓存异常
+    # (连接, 读取) 分开设置：连不上 10 秒即失败，慢速链路上的大文件允许读更久
+    with _http().get(OPENTOPO_URL, params=params, stream=True, timeout=(10, 120)) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"HTTP Error {r.status_code}: {r.reason}")
+
+        # 只看第一个块的文件头，错误页不必整包读完
+        chunks = r.iter_content(chunk_size=1 << 20)
+        head = next(chunks, b"")
+        if head[:4] not in TIFF_MAGICS:
+            raise RuntimeError(f"API Error: {head[:200].decode('utf-8', 'replace')}")
+
+        # 边收边写入磁盘，内存里任何时候只有一个块
+        path = _new_dem_path()
+        try:
+            with open(path, 'wb') as f:
+                f.write(head)
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path
+
+def api_key_digest(api_key):
+    # 缓存键只用 API Key 的短摘要，原始 key 不进入任何缓存
+    return hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest()
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _probe_api_key(key_digest, _api_key):
+    # 用华山附近约 100m 见方的极小范围探测一次；无效 key 返回 401/403
+    params = {
+        'demType': 'SRTMGL1',
+        'south': 34.475, 'north': 34.476, 'west': 110.08, 'east': 110.081,
+        'outputFormat': 'GTiff',
+        'API_Key': _api_key
+    }
+    # stream=True 只读响应头，不下载正文
+    with _http_probe().get(OPENTOPO_URL, params=params, stream=True, timeout=5) as r:
         if r.status_code == 200:
-            if 'text/html' in r.headers.get('Content-Type', ''):
-                return False, f"API Error: {r.text[:200]}"
-            return True, r.content
-        return False, f"HTTP Error {r.status_code}: {r.reason}"
+            return True
+        if r.status_code in (401, 403):
+            return False
+        # 其他状态视为暂时无法判断，抛异常以免被缓存
+        raise RuntimeError(f"HTTP Error {r.status_code}: {r.reason}")
+
+KEY_RECHECK_INTERVAL = 60  # 无法验证时，隔多久再探测一次
+
+def check_api_key(api_key):
+    """返回 True / False；服务暂时不可用时返回 None。"""
+    try:
+        return _probe_api_key(api_key_digest(api_key), api_key)
+    except Exception:
+        return None
+
+# API 单次请求的点数上限
+OPENTOPO_MAX_POINTS = 1e8
+
+def estimate_points(bounds, dem_type):
+    # 经纬度格网上的像元数，本地即可算出，超限请求不必发出
+    minx, miny, maxx, maxy = bounds
+    px_per_deg = 3600 / OPENTOPO_DATASETS[dem_type]
+    return (maxx - minx) * px_per_deg * (maxy - miny) * px_per_deg
+
+def fetch_opentopo_dem(bounds, api_key, dem_type='SRTMGL1'): # 默认回归最稳的 SRTM
+    n = estimate_points(bounds, dem_type)
+    if n > OPENTOPO_MAX_POINTS:
+        return False, f"范围过大，估计 {n:.1e} 点，超过 API 限制 1 亿点，请缩小范围或降低精度"
+
+    bounds_key = tuple(round(x, 5) for x in bounds)
+    try:
+        return True, _download_opentopo(bounds_key, dem_type, api_key_digest(api_key), api_key)
+    except RuntimeError as e:
+        # 自己抛出的错误信息不含请求 URL，可以直接展示
+        return False, str(e)
     except Exception as e:
+        # requests/urllib3 的异常文本带完整 URL（含 API Key），只显示异常类型
+        return False, f"下载失败 ({type(e).__name__})，请稍后重试"
+
+# 降采样级数 k：分辨率 = 30m × 2^k，None 表示按范围自动选择
+DEM_RESOLUTIONS = {"自动": None, "原始 30m": 0, "60m": 1, "120m": 2, "240m": 3}
+DEM_MAX_SIDE_PX = 4096
+
+def auto_downsample_level(bounds):
+    # 取最小的 k，使 1″ (约 30m) 原始格网降采样 2^k 倍后长边不超过 DEM_MAX_SIDE_PX
+    minx, miny, maxx, maxy = bounds
+    native_px = max(maxx - minx, maxy - miny) * 3600
+    return min(3, max(0, math.ceil(math.log2(native_px / DEM_MAX_SIDE_PX))))
+
+# Copernicus GLO-30 以 Cloud-Optimized GeoTIFF 形式公开托管在 AWS 上
+COP30_COG_ROOT = "https://copernicus-dem-30m.s3.amazonaws.com"
+COG_ENV = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    # HTTP/2 多路复用，并合并相邻的 Range 请求
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+}
+COG_MAX_WORKERS = 8
+
+@st.cache_resource
+def _cop30_tiles():
+    # 桶里公布的全部瓦片名（每行一个，约 2.6 万个），进程内只下载一次；
+    # 失败时抛异常，cache_resource 不缓存异常，下次读取时重试
+    r = _http().get(f"{COP30_COG_ROOT}/tileList.txt", timeout=(10, 60))
+    if r.status_code != 200:
+        raise RuntimeError(f"无法获取 Copernicus 瓦片列表 (HTTP {r.status_code})")
+    return frozenset(line.strip() for line in r.text.splitlines() if line.strip())
+
+def _cop30_tile_urls(bounds):
+    # GLO-30 按 1°×1° 分块，文件名取瓦片西南角的整数经纬度；
+    # 不在瓦片列表里的（海域等）直接跳过，读取时的任何错误都不再当作“无数据”
+    minx, miny, maxx, maxy = bounds
+    tiles = _cop30_tiles()
+    urls = []
+    for lat in range(math.floor(miny), math.ceil(maxy)):
+        for lon in range(math.floor(minx), math.ceil(maxx)):
+            ns = 'N' if lat >= 0 else 'S'
+            ew = 'E' if lon >= 0 else 'W'
+            name = f"Copernicus_DSM_COG_10_{ns}{abs(lat):02d}_00_{ew}{abs(lon):03d}_00_DEM"
+            if name in tiles:
+                urls.append(f"{COP30_COG_ROOT}/{name}/{name}.tif")
+    return urls
+
+def _read_cog_window(url, bounds, level=0):
+    # 只读与 bounds 相交的窗口，GDAL 用 HTTP Range 请求拉取对应的内部块；
+    # level > 0 时直接打开 COG 内置的第 level 级概视图 (OVERVIEW_LEVEL 从 0 起算，对应 2 倍降采样)
+    import rasterio
+    from rasterio.errors import RasterioIOError
+    from rasterio.io import MemoryFile
+    from rasterio.windows import from_bounds
+
+    minx, miny, maxx, maxy = bounds
+    with rasterio.Env(**COG_ENV):
+        try:
+            src = rasterio.open(url, **({'OVERVIEW_LEVEL': level - 1} if level > 0 else {}))
+        except RasterioIOError as e:
+            # 瓦片已按列表确认存在，打不开就是真的出错（超时、限流、5xx 等），一律抛出，
+            # 否则拼出来的 DEM 会缺块，还会被当作成功结果缓存；只把缺少概视图单独说明
+            if level > 0 and "overview level" in str(e):
+                raise RuntimeError(f"瓦片 {url.rsplit('/', 1)[-1]} 没有 {30 * 2 ** level}m 概视图，请选择更高精度") from e
+            raise
+        with src:
+            left, right = max(minx, src.bounds.left), min(maxx, src.bounds.right)
+            bottom, top = max(miny, src.bounds.bottom), min(maxy, src.bounds.top)
+            if left >= right or bottom >= top:
+                return None
+            win = from_bounds(left, bottom, right, top, transform=src.transform)
+            win = win.round_offsets().round_lengths()
+            if win.width < 1 or win.height < 1:
+                return None
+            arr = src.read(1, window=win)
+            profile = {
+                'driver': 'GTiff', 'count': 1, 'dtype': arr.dtype,
+                'height': arr.shape[0], 'width': arr.shape[1],
+                'crs': src.crs, 'transform': src.window_transform(win), 'nodata': src.nodata,
+            }
+
+    memfile = MemoryFile()
+    with memfile.open(**profile) as dst:
+        dst.write(arr, 1)
+    return memfile
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _download_cop30(bounds_key, level):
+    import rasterio
+    from rasterio.merge import merge
+
+    # 各瓦片的窗口读取互相独立且受网络 IO 限制，用线程并发发出
+    urls = _cop30_tile_urls(bounds_key)
+    if not urls:
+        raise RuntimeError("该范围内没有 Copernicus DEM 数据（可能全部位于海域）")
+    with ThreadPoolExecutor(max_workers=min(COG_MAX_WORKERS, len(urls))) as ex:
+        pieces = list(ex.map(lambda url: _read_cog_window(url, bounds_key, level), urls))
+    memfiles = [p for p in pieces if p is not None]
+    if not memfiles:
+        raise RuntimeError("该范围内没有 Copernicus DEM 数据（可能全部位于海域）")
+
+    datasets = [mf.open() for mf in memfiles]
+    try:
+        # 跨多个瓦片时只拼接各自读到的窗口
+        mosaic, transform = merge(datasets)
+        profile = datasets[0].profile
+        profile.update(height=mosaic.shape[1], width=mosaic.shape[2], transform=transform, compress='deflate')
+        path = _new_dem_path()
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(mosaic)
+        return path
+    finally:
+        for ds in datasets:
+            ds.close()
+        for mf in memfiles:
+            mf.close()
+
+def fetch_cop30_dem(bounds, level=0):
+    bounds_key = tuple(round(x, 5) for x in bounds)
+    try:
+        return True, _download_cop30(bounds_key, level)
+    except ImportError:
+        return False, "读取 COG 需要安装 rasterio"
+    except RuntimeError as e:
         return False, str(e)
+    except Exception as e:
+        # GDAL/网络异常只显示类型，不把原始请求信息直接贴到页面上
+        return False, f"读取失败 ({type(e).__name__})，请稍后重试"
 
 # --- 4. 侧边栏 ---
 
@@ -110,45 +519,54 @@ with st.sidebar:
         st.session_state.update({'lat': 34.5000, 'lon': 110.1000, 'addr': 'Hua Shan Region'})
     
     with st.expander("📍 1. 地点搜索", expanded=True):
-        q = st.text_input("输入地名", "华山")
-        if st.button("搜索"):
-            res = get_location(q)
-            if res:
-                st.session_state['lat'], st.session_state['lon'], st.session_state['addr'] = res
-                st.success("已定位")
-                time.sleep(0.5)
-                st.rerun()
+        q = st.text_input("输入地名", "华山", key="q_input")
+        if st.button("搜索", key="search_btn"):
+            try:
+                res = get_location(q)
+            except Exception as e:
+                st.error(f"地理编码服务暂时不可用，请稍后再试 ({type(e).__name__})")
             else:
-                st.error("未找到，请试着用拼音")
+                if res:
+                    # 搜索在读取位置的代码之前执行，本轮即可用新位置渲染，不必再 st.rerun() 整页重跑一次
+                    st.session_state['lat'], st.session_state['lon'], st.session_state['addr'] = res
+                    st.success("已定位")
+                else:
+                    st.error("未找到，请试着用拼音")
 
     with st.expander("📐 2. 范围设置", expanded=True):
-        shape = st.selectbox("形状", ["矩形 (Rectangle)", "圆形 (Circle)"])
-        if shape == "矩形 (Rectangle)":
-            c1, c2 = st.columns(2)
-            w = c1.number_input("宽 (km)", 0.1, 500.0, 20.0)
-            h = c2.number_input("高 (km)", 0.1, 500.0, 20.0)
-            r = 0
-        else:
-            r = st.number_input("半径 (km)", 0.1, 200.0, 10.0)
-            w, h = 0, 0
+        # 形状决定下面显示哪些输入框，必须留在表单外，切换后立即重跑
+        shape = st.selectbox("形状", ["矩形 (Rectangle)", "圆形 (Circle)"], key="shape")
+        # 尺寸放进表单：调整多个数值时只在点“应用”后重跑一次
+        with st.form("params"):
+            if shape == "矩形 (Rectangle)":
+                c1, c2 = st.columns(2)
+                w = c1.number_input("宽 (km)", 0.1, 500.0, 20.0, key="w_km")
+                h = c2.number_input("高 (km)", 0.1, 500.0, 20.0, key="h_km")
+                r = 0
+            else:
+                r = st.number_input("半径 (km)", 0.1, 200.0, 10.0, key="r_km")
+                w, h = 0, 0
+            precise = st.checkbox("高精度 (WGS84 椭球)", False, key="precise", help="默认按球面近似计算，误差约 0.6% 以内")
+            st.form_submit_button("应用", use_container_width=True)
+
+    # 几何只在这里算一次，侧边栏坐标与主界面地图、下载共用同一结果
+    geom_wkb, bounds, desc = generate_geometry(st.session_state['lat'], st.session_state['lon'], shape, w, h, r, precise)
 
     st.divider()
 
     # --- 地理空间数据云助手 ---
     st.subheader("🇨🇳 地理空间数据云助手")
     st.info("GSCloud 必须手动下载。请复制以下坐标用于其高级搜索：")
-    
-    # 这里需要先计算一次bounds来显示
-    _, temp_bounds, _ = generate_geometry(st.session_state['lat'], st.session_state['lon'], shape, w, h, r) if 'generate_geodesic_circle' not in globals() else (None, None, None) # Placeholder fix logic below
-    
-    # 重新实时计算用于显示的 Bounds
-    temp_geom, _ = generate_geometry(st.session_state['lat'], st.session_state['lon'], shape, w, h, r)
-    b = temp_geom.bounds # minx, miny, maxx, maxy
-    
-    st.text_input("最小经度 (Min Lon)", f"{b[0]:.5f}")
-    st.text_input("最大经度 (Max Lon)", f"{b[2]:.5f}")
-    st.text_input("最小纬度 (Min Lat)", f"{b[1]:.5f}")
-    st.text_input("最大纬度 (Max Lat)", f"{b[3]:.5f}")
+
+    # 坐标只供复制，不需要可编辑的输入框；一个代码块自带复制按钮，也不产生控件状态
+    with st.expander("📋 范围坐标", expanded=False):
+        st.code(
+            f"最小经度 (Min Lon): {bounds[0]:.5f}\n"
+            f"最大经度 (Max Lon): {bounds[2]:.5f}\n"
+            f"最小纬度 (Min Lat): {bounds[1]:.5f}\n"
+            f"最大纬度 (Max Lat): {bounds[3]:.5f}",
+            language="text"
+        )
     
     st.markdown("[👉 前往地理空间数据云 (gscloud.cn)](http://www.gscloud.cn/search)")
 
@@ -156,38 +574,52 @@ with st.sidebar:
 
 st.subheader(f"🗺️ {st.session_state['addr']}")
 
-geom, desc = generate_geometry(st.session_state['lat'], st.session_state['lon'], shape, w, h, r)
-gdf = gpd.GeoDataFrame({'geometry': [geom]}, crs="EPSG:4326")
-bounds = geom.bounds
-
 # --- 地图设置 (DEM 风格) ---
-# 使用 OpenTopoMap，它带有明显的等高线和地形阴影
-map_key = f"map_{st.session_state['lat']}_{st.session_state['lon']}_{shape}_{w}_{h}_{r}"
-m = folium.Map(
-    location=[st.session_state['lat'], st.session_state['lon']], 
-    zoom_start=11,
-    tiles="https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png",
-    attr='Map data: &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors, <a href="http://viewfinderpanoramas.org">SRTM</a> | Map style: &copy; <a href="https://opentopomap.org">OpenTopoMap</a> (<a href="https://creativecommons.org/licenses/by-sa/3.0/">CC-BY-SA</a>)'
-)
-
-# 绘制几何
-folium.GeoJson(
-    gdf,
-    style_function=lambda x: {
-        'fillColor': '#007AFF', 
-        'color': '#007AFF', 
-        'weight': 3, 
-        'fillOpacity': 0.1
-    }
-).add_to(m)
 
-# 中心点
-folium.Marker(
-    [st.session_state['lat'], st.session_state['lon']],
-    icon=folium.Icon(color='red', icon='info-sign')
-).add_to(m)
+@st.cache_data(max_entries=32, show_spinner=False)
+def map_html(lat, lon, geom_wkb, name, desc):
+    # 完整地图（底图 + ROI + 中心点）渲染成 HTML 后按几何缓存，参数不变的重跑和其他会话直接复用
+    import folium
+
+    # 只有一个多边形，用 Canvas 渲染减少 DOM 节点；不要默认底图和比例尺
+    m = folium.Map(
+        location=[lat, lon], 
+        zoom_start=11,
+        tiles=None,
+        prefer_canvas=True,
+        control_scale=False
+    )
+
+    # 使用 OpenTopoMap，它带有明显的等高线和地形阴影（最大缩放 17 级，不请求高分屏瓦片）
+    folium.TileLayer(
+        tiles="https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png",
+        attr='Map data: &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors, <a href="http://viewfinderpanoramas.org">SRTM</a> | Map style: &copy; <a href="https://opentopomap.org">OpenTopoMap</a> (<a href="https://creativecommons.org/licenses/by-sa/3.0/">CC-BY-SA</a>)',
+        name="OpenTopoMap",
+        max_zoom=17,
+        detect_retina=False
+    ).add_to(m)
 
-st_folium(m, height=500, width="100%", key=map_key)
+    # 绘制几何
+    folium.GeoJson(
+        _feature_collection(geom_wkb, name, desc),
+        style_function=lambda x: {
+            'fillColor': '#007AFF', 
+            'color': '#007AFF', 
+            'weight': 3, 
+            'fillOpacity': 0.1
+        }
+    ).add_to(m)
+
+    # 中心点
+    folium.Marker(
+        [lat, lon],
+        icon=folium.Icon(color='red', icon='info-sign')
+    ).add_to(m)
+
+    return m.get_root().render()
+
+# 地图只做展示，不读回任何交互状态：直接嵌入静态 HTML，平移/缩放完全在浏览器里进行，不会触发重跑
+components.html(map_html(st.session_state['lat'], st.session_state['lon'], geom_wkb, st.session_state['addr'], desc), height=500)
 
 # --- 下载区 ---
 st.divider()
@@ -197,7 +629,7 @@ with c1:
     st.markdown("### 📥 1. 矢量范围")
     st.download_button(
         "下载 GeoJSON", 
-        gdf.to_json(), 
+        _geojson_for(geom_wkb, st.session_state['addr'], desc), 
         f"ROI_{desc}.geojson", 
         "application/geo+json", 
         use_container_width=True
@@ -205,29 +637,86 @@ with c1:
 
 with c2:
     st.markdown("### ⛰️ 2. 高程数据 (DEM)")
+
+    # “自动”在两个来源里的含义不同：OpenTopo 只在超出 API 点数上限时才降到 90m，
+    # COG 则按 DEM_MAX_SIDE_PX 像素预算选择概视图级别
+    res_choice = st.radio("精度", list(DEM_RESOLUTIONS), horizontal=True)
+    level = DEM_RESOLUTIONS[res_choice]
     
-    tab1, tab2 = st.tabs(["OpenTopo API (自动)", "GSCloud (手动)"])
+    tab1, tab3, tab2 = st.tabs(["OpenTopo API (自动)", "Copernicus COG (免 Key)", "GSCloud (手动)"])
     
     with tab1:
-        st.caption("源: SRTM 30m (美国服务器)")
+        # API 不提供概视图，需要降采样时改用最接近的 90m 数据集
+        if level is None:
+            use_30m = estimate_points(bounds, 'SRTMGL1') <= OPENTOPO_MAX_POINTS
+        else:
+            use_30m = level == 0
+        if use_30m:
+            dem_type = DATASET_MAP[st.selectbox("数据集", list(DATASET_MAP))]
+            st.caption(f"源: {dem_type} 30m (美国服务器)")
+        else:
+            dem_type = 'COP90'
+            st.caption("源: Copernicus 90m (COP90，范围较大或已选低精度)")
         api_key = st.text_input("OpenTopo API Key", type="password", key="main_key")
+
+        # 每个会话对同一个 key 只验证一次，结果以 (摘要, 是否有效, 时间戳) 存在 session_state；
+        # “暂时无法验证”也记下来，KEY_RECHECK_INTERVAL 秒内不再探测，免得每次重跑都卡在网络上
+        key_ok = None
+        if api_key:
+            digest = api_key_digest(api_key)
+            cached = st.session_state.get('api_key_ok')
+            if cached and cached[0] == digest and (cached[1] is not None or time.time() - cached[2] < KEY_RECHECK_INTERVAL):
+                key_ok = cached[1]
+            else:
+                key_ok = check_api_key(api_key)
+                st.session_state['api_key_ok'] = (digest, key_ok, time.time())
+            st.caption({True: "🟢 API Key 有效", False: "🔴 API Key 无效"}.get(key_ok, "⚪ 暂时无法验证 API Key"))
         
-        if 'dem_data' not in st.session_state: st.session_state['dem_data'] = None
+        if 'dem_path' not in st.session_state: st.session_state['dem_path'] = None
         
+        n_points = estimate_points(bounds, dem_type)
+        st.caption(f"预计 {n_points:.1e} 点" + ("（超过 API 上限 1 亿点）" if n_points > OPENTOPO_MAX_POINTS else ""))
+
         if st.button("🚀 开始下载", use_container_width=True):
             if not api_key:
                 st.error("请输入 API Key")
+            elif key_ok is False:
+                st.error("API Key 无效，请检查后重试")
             else:
                 with st.spinner("下载中..."):
-                    ok, d = fetch_opentopo_dem(bounds, api_key)
+                    ok, d = fetch_opentopo_dem(bounds, api_key, dem_type)
                     if ok:
-                        st.session_state['dem_data'] = d
+                        st.session_state['dem_path'] = d
+                        st.session_state['dem_size'] = os.path.getsize(d)
                         st.success("完成！")
                     else:
                         st.error(d)
         
-        if st.session_state['dem_data']:
-            st.download_button("💾 保存 .TIF", st.session_state['dem_data'], f"DEM_{desc}.tif", "image/tiff", use_container_width=True, type="primary")
+        # 会话里只保存文件路径和大小；文件可能已过期被清理
+        if st.session_state['dem_path'] and os.path.exists(st.session_state['dem_path']):
+            st.download_button(f"💾 保存 .TIF ({st.session_state['dem_size'] / 2**20:.1f} MB)", _file_reader(st.session_state['dem_path']), f"DEM_{desc}.tif", "image/tiff", use_container_width=True, type="primary")
+
+    with tab3:
+        # 大范围时默认读取概视图，避免下载上 GB 的原始栅格
+        cog_level = auto_downsample_level(bounds) if level is None else level
+        st.caption(f"源: Copernicus GLO-30 (AWS 公开 COG，只读取范围内的数据块)，输出约 {30 * 2 ** cog_level}m")
+
+        if 'cop_path' not in st.session_state: st.session_state['cop_path'] = None
+
+        if not HAS_RASTERIO:
+            st.info("读取 COG 需要 rasterio：pip install -r requirements-cog.txt")
+        if st.button("🚀 读取 COG", use_container_width=True, disabled=not HAS_RASTERIO):
+            with st.spinner("读取中..."):
+                ok, d = fetch_cop30_dem(bounds, cog_level)
+                if ok:
+                    st.session_state['cop_path'] = d
+                    st.session_state['cop_size'] = os.path.getsize(d)
+                    st.success("完成！")
+                else:
+                    st.error(d)
+
+        if st.session_state['cop_path'] and os.path.exists(st.session_state['cop_path']):
+            st.download_button(f"💾 保存 .TIF ({st.session_state['cop_size'] / 2**20:.1f} MB)", _file_reader(st.session_state['cop_path']), f"COP30_{desc}.tif", "image/tiff", use_container_width=True, type="primary", key="save_cop")
 
     with tab2:
         st.write("**地理空间数据云** 无法自动下载，请使用以下信息：")